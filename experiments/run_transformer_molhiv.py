@@ -130,12 +130,6 @@ def train_epoch(model, loader, criterion, optimizer, lr_scheduler, epoch, use_cu
             iteration = epoch * len(loader) + i
             for param_group in optimizer.param_groups:
                 param_group["lr"] = lr_scheduler(iteration)
-        if args.lappe:
-            # sign flip as in Bresson et al. for laplacian PE
-            sign_flip = torch.rand(lap_pe.shape[-1])
-            sign_flip[sign_flip >= 0.5] = 1.0
-            sign_flip[sign_flip < 0.5] = -1.0
-            lap_pe = lap_pe * sign_flip.unsqueeze(0)
 
         if use_cuda:
             data = data.cuda()
@@ -148,6 +142,12 @@ def train_epoch(model, loader, criterion, optimizer, lr_scheduler, epoch, use_cu
                 degree = degree.cuda()
             labels = labels.cuda()
 
+        if args.lappe:
+            # sign flip as in Bresson et al. for laplacian PE
+            sign_flip = torch.empty(lap_pe.shape[-1], device=lap_pe.device)
+            sign_flip = sign_flip.bernoulli_(0.5).mul_(2).sub_(1)
+            lap_pe = lap_pe * sign_flip
+
         optimizer.zero_grad()
         output = model(data, mask, pe, lap_pe, degree)
         loss = criterion(output, labels)
@@ -15,7 +15,7 @@ from transformer.models_test import DiffGraphTransformer, GraphTransformer
 from transformer.data_test import GraphDataset
 from transformer.position_encoding_test import LapEncoding, FullEncoding, POSENCODINGS
 from transformer.gckn_pe import GCKNEncoding
-from transformer.utils import count_parameters
+from transformer.utils import count_parameters, CUDAPrefetcher
 from timeit import default_timer as timer
 from torch import nn, optim
 
@@ -23,6 +23,16 @@ from ogb.graphproppred import PygGraphPropPredDataset
 from ogb.utils.features import get_atom_feature_dims, get_bond_feature_dims
 from ogb.graphproppred import Evaluator
 
+EVALUATOR = Evaluator(name='ogbg-molhiv')
+
+
+def available_cpus():
+    try:
+        # respects cgroup/affinity limits, Linux only
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
 
 def load_args():
     parser = argparse.ArgumentParser(
@@ -62,9 +72,32 @@ def load_args():
     parser.add_argument('--zero-diag', action='store_true', help='zero diagonal for PE matrix')
     parser.add_argument('--use-edge-attr', action='store_true', help='use edge features')
     parser.add_argument('--weight-decay', default=0.01, type=float, help='weight decay')
+    parser.add_argument('--num-workers', type=int, default=min(8, available_cpus()),
+                        help='number of data loading workers')
+    parser.add_argument('--n-jobs', type=int, default=None,
+                        help='number of processes computing position encodings '
+                             '(default: serial for small graphs, else all CPUs)')
+    parser.add_argument('--compile', dest='compile', action='store_true',
+                        help='compile the model with torch.compile (GPU only)')
+    parser.add_argument('--no-compile', dest='compile', action='store_false')
+    parser.set_defaults(compile=False)
+    parser.add_argument('--pad-multiple', type=int, default=None,
+                        help='pad batches to a multiple of this number of nodes '
+                             '(default: 32 with --compile, else 1)')
     args = parser.parse_args()
     args.use_cuda = torch.cuda.is_available()
+    # reduce-overhead mode captures CUDA graphs
+    args.compile = args.compile and args.use_cuda
+    # mixed precision: bf16 where supported, else fp16 with loss scaling
+    args.amp_dtype = torch.float16
+    # native bf16 needs Ampere or newer, emulated bf16 is slower than fp16
+    if args.use_cuda and torch.cuda.get_device_capability()[0] >= 8:
+        args.amp_dtype = torch.bfloat16
     args.batch_norm = not args.layer_norm
+    # padded nodes enter the BatchNorm statistics, so only pad further when
+    # --compile is set and few distinct shapes avoid recompilation
+    if args.pad_multiple is None:
+        args.pad_multiple = 32 if args.compile else 1
 
     args.save_logs = False
     if args.outdir != '':
@@ -124,35 +157,28 @@ def load_args():
     return args
 
 
-def train_epoch(model, loader, criterion, optimizer, lr_scheduler, epoch, use_cuda=False):
+def train_epoch(model, loader, criterion, optimizer, lr_scheduler, epoch, scaler, use_cuda=False):
     model.train()
 
     running_loss = 0.0
 
     tic = timer()
-    for i, (data, mask, pe, lap_pe, degree, labels) in enumerate(loader):
-        labels = labels.float()
+    batches = CUDAPrefetcher(loader) if use_cuda else loader
+    for i, (data, mask, pe, lap_pe, degree, labels) in enumerate(batches):
         if args.warmup is not None:
             iteration = epoch * len(loader) + i
             for param_group in optimizer.param_groups:
                 param_group["lr"] = lr_scheduler(iteration)
 
-        if use_cuda:
-            data = data.cuda()
-            mask = mask.cuda()
-            if pe is not None:
-                pe = pe.cuda()
-            if lap_pe is not None:
-                lap_pe = lap_pe.cuda()
-            if degree is not None:
-                degree = degree.cuda()
-            labels = labels.cuda()
-
-        optimizer.zero_grad()
-        output = model(data, mask, pe, lap_pe, degree)
-        loss = criterion(output, labels)
-        loss.backward()
-        optimizer.step()
+        labels = labels.float()
+
+        optimizer.zero_grad(set_to_none=True)
+        with torch.autocast('cuda', dtype=args.amp_dtype, enabled=use_cuda):
+            output = model(data, mask, pe, lap_pe, degree)
+            loss = criterion(output, labels)
+        scaler.scale(loss).backward()
+        scaler.step(optimizer)
+        scaler.update()
 
         running_loss += loss.item() * len(data)
 
@@ -167,40 +193,34 @@ def train_epoch(model, loader, criterion, optimizer, lr_scheduler, epoch, use_cu
 def eval_epoch(model, loader, criterion, use_cuda=False):
     model.eval()
 
-    running_loss = 0.0
-    y_true = []
-    y_pred = []
+    n_sample = len(loader.dataset)
+    device = 'cuda' if use_cuda else 'cpu'
+    # accumulate on device and copy back once to avoid a sync per batch
+    running_loss = torch.zeros((), device=device)
+    y_true = torch.empty((n_sample, 1), device=device)
+    y_pred = torch.empty((n_sample, 1), device=device)
+    offset = 0
 
     tic = timer()
+    batches = CUDAPrefetcher(loader) if use_cuda else loader
     with torch.no_grad():
-        for data, mask, pe, lap_pe, degree, labels in loader:
+        for data, mask, pe, lap_pe, degree, labels in batches:
             labels = labels.float()
 
-            if use_cuda:
-                data = data.cuda()
-                mask = mask.cuda()
-                if pe is not None:
-                    pe = pe.cuda()
-                if lap_pe is not None:
-                    lap_pe = lap_pe.cuda()
-                if degree is not None:
-                    degree = degree.cuda()
-                labels = labels.cuda()
-
-            output = model(data, mask, pe, lap_pe, degree)
-            loss = criterion(output, labels)
-            y_true.append(labels.cpu())
-            y_pred.append(output.sigmoid().cpu())
-            
+            with torch.autocast('cuda', dtype=args.amp_dtype, enabled=use_cuda):
+                output = model(data, mask, pe, lap_pe, degree)
+                loss = criterion(output, labels)
+            bs = labels.shape[0]
+            y_true[offset:offset + bs] = labels
+            y_pred[offset:offset + bs] = output.sigmoid()
+            offset += bs
 
-            running_loss += loss.item() * len(data)
+            running_loss += loss * len(data)
     toc = timer()
 
-    n_sample = len(loader.dataset)
-    epoch_loss = running_loss / n_sample
-    evaluator = Evaluator(name='ogbg-molhiv')
-    auc = evaluator.eval({'y_pred': torch.cat(y_pred),
-                             'y_true': torch.cat(y_true)})['rocauc']
+    epoch_loss = running_loss.item() / n_sample
+    auc = EVALUATOR.eval({'y_pred': y_pred.cpu(),
+                             'y_true': y_true.cpu()})['rocauc']
     print('Val loss: {:.4f} auROC: {:.4f} time: {:.2f}s'.format(
           epoch_loss, auc, toc - tic))
     return auc, epoch_loss
@@ -237,14 +257,21 @@ def main():
 
     print(len(gckn_pos_enc_values))
 
+    loader_kwargs = {'num_workers': args.num_workers, 'pin_memory': args.use_cuda}
+    if args.num_workers > 0:
+        # keep prefetch_factor small, pinned buffers grow with it
+        loader_kwargs.update(persistent_workers=True, prefetch_factor=2)
+
     train_dset = GraphDataset(train_dset, n_tags, degree=True)
     input_size = train_dset.input_size()
-    train_loader = DataLoader(train_dset, batch_size=args.batch_size, shuffle=True, collate_fn=train_dset.collate_fn())
+    train_loader = DataLoader(train_dset, batch_size=args.batch_size, shuffle=True, collate_fn=train_dset.collate_fn(args.pad_multiple),
+        **loader_kwargs)
     print(len(train_dset))
     print(train_dset[0])
 
     val_dset = GraphDataset(val_dset, n_tags, degree=True)
-    val_loader = DataLoader(val_dset, batch_size=args.batch_size, shuffle=False, collate_fn=val_dset.collate_fn())
+    val_loader = DataLoader(val_dset, batch_size=args.batch_size, shuffle=False, collate_fn=val_dset.collate_fn(args.pad_multiple),
+        **loader_kwargs)
 
     pos_encoder = None
     if args.pos_enc is not None:
@@ -275,13 +302,13 @@ def main():
                 zero_diag=args.zero_diag, **pos_encoding_params)
 
         print("Position encoding...")
-        pos_encoder.apply_to(train_dset, split='train')
-        pos_encoder.apply_to(val_dset, split='val')
+        pos_encoder.apply_to(train_dset, split='train', n_jobs=args.n_jobs)
+        pos_encoder.apply_to(val_dset, split='val', n_jobs=args.n_jobs)
     else:
         if args.zero_diag:
             pos_encoder = FullEncoding(None, args.zero_diag)
-            pos_encoder.apply_to(train_dset, split='train')
-            pos_encoder.apply_to(val_dset, split='val')
+            pos_encoder.apply_to(train_dset, split='train', n_jobs=args.n_jobs)
+            pos_encoder.apply_to(val_dset, split='val', n_jobs=args.n_jobs)
 
     train_dset.lap_pe_list = gckn_pos_enc_values[:len(train_dset)]
     val_dset.lap_pe_list = gckn_pos_enc_values[len(train_dset):len(train_dset)+len(val_dset)]
@@ -314,9 +341,16 @@ def main():
     if args.use_cuda:
         model.cuda()
     print("Total number of parameters: {}".format(count_parameters(model)))
+    # compiled module shares parameters with model, whose state_dict keys are kept
+    compiled_model = model
+    if args.compile:
+        compiled_model = torch.compile(model, mode='reduce-overhead', fullgraph=False)
 
     criterion = nn.BCEWithLogitsLoss()
-    optimizer = optim.AdamW(model.parameters(), lr=args.lr, weight_decay=args.weight_decay)
+    scaler = torch.amp.GradScaler(
+        'cuda', enabled=args.use_cuda and args.amp_dtype == torch.float16)
+    optimizer = optim.AdamW(model.parameters(), lr=args.lr, weight_decay=args.weight_decay,
+                            fused=args.use_cuda)
     if args.warmup is None:
         lr_scheduler = optim.lr_scheduler.ReduceLROnPlateau(optimizer, mode='min',
                                                      factor=0.5,
@@ -334,9 +368,10 @@ def main():
             return lr
 
     test_dset = GraphDataset(test_dset, n_tags, degree=True)
-    test_loader = DataLoader(test_dset, batch_size=args.batch_size, shuffle=False, collate_fn=test_dset.collate_fn())
+    test_loader = DataLoader(test_dset, batch_size=args.batch_size, shuffle=False, collate_fn=test_dset.collate_fn(args.pad_multiple),
+        **loader_kwargs)
     if pos_encoder is not None:
-        pos_encoder.apply_to(test_dset, split='test')
+        pos_encoder.apply_to(test_dset, split='test', n_jobs=args.n_jobs)
 
     test_dset.lap_pe_list = gckn_pos_enc_values[len(train_dset)+len(val_dset):]
     test_dset.lap_pe_dim = gckn_dim
@@ -349,16 +384,14 @@ def main():
     start_time = timer()
     for epoch in range(args.epochs):
         print("Epoch {}/{}, LR {:.6f}".format(epoch + 1, args.epochs, optimizer.param_groups[0]['lr']))
-        train_loss = train_epoch(model, train_loader, criterion, optimizer, lr_scheduler, epoch, args.use_cuda)
-        val_score, val_loss = eval_epoch(model, val_loader, criterion, args.use_cuda)
-        test_score,_ = eval_epoch(model, test_loader, criterion, args.use_cuda)
+        train_loss = train_epoch(compiled_model, train_loader, criterion, optimizer, lr_scheduler, epoch, scaler, args.use_cuda)
+        val_score, val_loss = eval_epoch(compiled_model, val_loader, criterion, args.use_cuda)
 
         if args.warmup is None:
             lr_scheduler.step(val_loss)
 
         logs['train_loss'].append(train_loss)
         logs['val_score'].append(val_score)
-        logs['test_score'].append(test_score)
         if val_score > best_val_score:
             best_val_score = val_score
             best_epoch = epoch
@@ -369,7 +402,7 @@ def main():
 
     print()
     print("Testing...")
-    test_score, test_loss = eval_epoch(model, test_loader, criterion, args.use_cuda)
+    test_score, test_loss = eval_epoch(compiled_model, test_loader, criterion, args.use_cuda)
 
     print("test auROC {:.4f}".format(test_score))
 
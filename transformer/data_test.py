@@ -57,10 +57,14 @@ class GraphDataset(object):
                 onehot = atom_one_hot(g.x, self.n_tags)
                 self.x_onehot.append(onehot)
 
-    def collate_fn(self):
+    def collate_fn(self, pad_multiple=1):
+        """pad_multiple: round the padded length up to a multiple of it so that
+        batch shapes only take a few distinct values
+        """
         def collate(batch):
             batch = list(batch)
             max_len = max(len(g.x) for g in batch)
+            max_len = ((max_len + pad_multiple - 1) // pad_multiple) * pad_multiple
 
             padded_x = torch.zeros((len(batch), max_len, self.input_size()))
             mask = torch.zeros((len(batch), max_len), dtype=bool)
@@ -107,7 +107,7 @@ class GCKNEncoding(object):
             return
         if not os.path.isfile(self.savepath):
             with open(self.savepath, 'wb') as handle:
-                pickle.dump(pos_enc, handle)
+                pickle.dump(pos_enc, handle, protocol=pickle.HIGHEST_PROTOCOL)
 
     def load(self):
         if not os.path.isfile(self.savepath):
@@ -153,9 +153,16 @@ class LapEncoding(PositionEncoding):
         edge_index, edge_attr = get_laplacian(
             graph.edge_index, edge_attr, normalization=self.normalization)
         L = to_scipy_sparse_matrix(edge_index, edge_attr).tocsc()
-        EigVal, EigVec = np.linalg.eig(L.toarray())
-        idx = EigVal.argsort() # increasing order
-        EigVal, EigVec = EigVal[idx], np.real(EigVec[:,idx])
+        if self.normalization == 'rw':
+            # random walk Laplacian is not symmetric
+            EigVal, EigVec = np.linalg.eig(L.toarray())
+            idx = EigVal.argsort() # increasing order
+            EigVal, EigVec = EigVal[idx], np.real(EigVec[:,idx])
+        else:
+            L = L.toarray()
+            L = 0.5 * (L + L.T)
+            # eigenvalues are returned in increasing order
+            EigVal, EigVec = np.linalg.eigh(L)
         return torch.from_numpy(EigVec[:, 1:self.pos_enc_dim+1]).float()
 
     def apply_to(self, dataset):
@@ -1,36 +1,66 @@
 import os
 import pickle
+import zipfile
+from itertools import accumulate
+from collections import defaultdict, namedtuple
 
 import torch
 import torch.nn.functional as F
-from torch_geometric.utils import get_laplacian, to_scipy_sparse_matrix, to_dense_adj
+from torch_geometric.utils import to_dense_adj
 import numpy as np
-import scipy.sparse as sp
-from scipy.sparse.linalg import expm
+from joblib import Parallel, delayed
+
+
+# graph fields that PE computations read, sent to workers instead of the full item
+GraphStructure = namedtuple('GraphStructure', ['edge_index', 'edge_attr', 'num_nodes'])
+
+# below this average number of nodes a graph's PE costs less than sending it to a worker
+PARALLEL_MIN_NODES = 64
+
+
+class PackedPositionEncoding(object):
+    """read-only list of PE matrices stored in a single flat buffer
+    buf: flat tensor, offsets: list of size N + 1, shapes: list of size N
+    """
+    def __init__(self, buf, offsets, shapes):
+        self.buf = buf
+        self.offsets = offsets
+        self.shapes = shapes
+
+    def __len__(self):
+        return len(self.shapes)
+
+    def __getitem__(self, index):
+        start, end = self.offsets[index], self.offsets[index + 1]
+        return self.buf[start:end].view(self.shapes[index])
 
 
 class PositionEncoding(object):
     def __init__(self, savepath=None, zero_diag=False):
+        if savepath is not None and zero_diag:
+            # saved PE already has a zero diagonal
+            root, ext = os.path.splitext(savepath)
+            savepath = root + "_zero_diag" + ext
         self.savepath = savepath
         self.zero_diag = zero_diag
+        self._cache = {}
 
-    def apply_to(self, dataset, split='train'):
+    def __getstate__(self):
+        # loaded PEs are not needed to compute new ones, don't send them to workers
+        state = self.__dict__.copy()
+        state['_cache'] = {}
+        return state
+
+    def apply_to(self, dataset, split='train', n_jobs=None):
         saved_pos_enc = self.load(split)
-        all_pe = []
+        if saved_pos_enc is not None:
+            dataset.pe_list = saved_pos_enc
+            return dataset
         dataset.pe_list = []
-        for i, g in enumerate(dataset):
-            if saved_pos_enc is None:
-                pe = self.compute_pe(g)
-                all_pe.append(pe)
-            else:
-                pe = saved_pos_enc[i]
-            if self.zero_diag:
-                pe = pe.clone()
-                if hasattr(self, "use_edge_attr") and self.use_edge_attr:
-                    pe.diagonal(dim1=1, dim2=2)[:] = 0
-                else:
-                    pe.diagonal()[:] = 0
-            dataset.pe_list.append(pe)
+        all_pe = self.compute_dataset_pe(dataset, n_jobs)
+        dataset.pe_list = all_pe
+        if not all_pe:
+            return dataset
 
         self.save(all_pe, split)
 
@@ -40,28 +70,59 @@ class PositionEncoding(object):
         if self.savepath is None:
             return
         if not os.path.isfile(self.savepath + "." + split):
-            with open(self.savepath + "." + split, 'wb') as handle:
-                pickle.dump(pos_enc, handle)
+            offsets = [0]
+            for pe in pos_enc:
+                offsets.append(offsets[-1] + pe.numel())
+            torch.save({
+                'buf': torch.cat([pe.reshape(-1) for pe in pos_enc]),
+                'offsets': torch.tensor(offsets),
+                'shapes': [tuple(pe.shape) for pe in pos_enc]},
+                self.savepath + "." + split)
 
     def load(self, split):
         if self.savepath is None:
             return None
+        if split in self._cache:
+            return self._cache[split]
         if not os.path.isfile(self.savepath + "." + split):
             return None
-        with open(self.savepath + "." + split, 'rb') as handle:
-            pos_enc = pickle.load(handle)
+        if not zipfile.is_zipfile(self.savepath + "." + split):
+            # cache written by older versions: pickled list of tensors
+            with open(self.savepath + "." + split, 'rb') as handle:
+                pos_enc = pickle.load(handle)
+        else:
+            # memory-mapped so that PE pages are only read when accessed
+            pos_enc = torch.load(self.savepath + "." + split, mmap=True)
+            pos_enc = PackedPositionEncoding(
+                pos_enc['buf'], pos_enc['offsets'].tolist(), pos_enc['shapes'])
+        self._cache[split] = pos_enc
         return pos_enc
 
     def compute_pe(self, graph):
         pass
 
+    def compute_dataset_pe(self, dataset, n_jobs=None):
+        return compute_all_pe(self, dataset, n_jobs)
+
+    def remove_diag(self, pe):
+        """zero the diagonal of pe in place if zero_diag is set
+        pe: n x n or C x n x n
+        """
+        if self.zero_diag:
+            pe.diagonal(dim1=-2, dim2=-1).zero_()
+        return pe
+
 
-class DiffusionEncoding(PositionEncoding):
-    def __init__(self, savepath, beta=1., use_edge_attr=False, normalization=None, zero_diag=False, num_edge_features=4):
+class LaplacianKernelEncoding(PositionEncoding):
+    def __init__(self, savepath, beta, use_edge_attr=False, normalization=None, zero_diag=False, num_edge_features=4,
+                 use_cuda=None):
         """
+        kernel of the Laplacian, one channel per edge feature with use_edge_attr
         normalization: for Laplacian None. sym or rw
+        use_cuda: batch the computation on GPU, default: if available
         """
         super().__init__(savepath, zero_diag)
+        self.use_cuda = torch.cuda.is_available() if use_cuda is None else use_cuda
         self.beta = beta
         self.normalization = normalization
         self.use_edge_attr = use_edge_attr
@@ -71,62 +132,63 @@ class DiffusionEncoding(PositionEncoding):
         else:
             self.num_edge_features_true = sum(num_edge_features)
 
-    def compute_pe(self, graph):
+    def laplacian(self, graph):
+        """n x n Laplacian, or C x n x n with one Laplacian per edge feature
+        """
         if self.use_edge_attr:
             # edge_attr_list = F.one_hot(graph.edge_attr - 1, self.num_edge_features).float()
             edge_attr_list = edge_attr_one_hot(graph.edge_attr, self.num_edge_features)
-            pe_tensors = torch.zeros((self.num_edge_features_true, graph.num_nodes, graph.num_nodes))
-            for i in range(self.num_edge_features_true):
-                pe_i = self.compute_pe_from_edge_weight(
-                    graph.edge_index, edge_attr_list[:, i], graph.num_nodes)
-                pe_tensors[i] = pe_i
-            return pe_tensors
-        return self.compute_pe_from_edge_weight(graph.edge_index, None, graph.num_nodes)
+            return torch.stack([dense_laplacian(
+                graph.edge_index, edge_attr_list[:, i], graph.num_nodes,
+                self.normalization) for i in range(self.num_edge_features_true)])
+        return dense_laplacian(graph.edge_index, None, graph.num_nodes, self.normalization)
 
-    def compute_pe_from_edge_weight(self, edge_index, edge_weight, num_nodes):
-        edge_index, edge_weight = get_laplacian(
-                edge_index, edge_weight, normalization=self.normalization,
-                num_nodes=num_nodes)
-        L = to_scipy_sparse_matrix(edge_index, edge_weight).tocsc()
-        L = expm(-self.beta * L)
-        return torch.from_numpy(L.toarray())
+    def compute_pe_from_laplacian(self, L):
+        pass
 
+    def compute_pe(self, graph):
+        # batched over the edge feature channels
+        return self.remove_diag(self.compute_pe_from_laplacian(self.laplacian(graph)))
 
-class PStepRWEncoding(PositionEncoding):
-    def __init__(self, savepath, p=1, beta=0.5, use_edge_attr=False, normalization=None, zero_diag=False, num_edge_features=4):
-        super().__init__(savepath, zero_diag)
-        self.p = p
-        self.beta = beta
-        self.normalization = normalization
-        self.use_edge_attr = use_edge_attr
-        self.num_edge_features = num_edge_features
-        if isinstance(num_edge_features, int):
-            self.num_edge_features_true = num_edge_features
-        else:
-            self.num_edge_features_true = sum(num_edge_features)
+    def compute_dataset_pe(self, dataset, n_jobs=None):
+        if not self.use_cuda:
+            return super().compute_dataset_pe(dataset, n_jobs)
+        all_pe = apply_by_size(self.compute_pe_from_laplacian, dataset, self.laplacian)
+        return [self.remove_diag(pe) for pe in all_pe]
+
+
+class DiffusionEncoding(LaplacianKernelEncoding):
+    def __init__(self, savepath, beta=1., use_edge_attr=False, normalization=None, zero_diag=False, num_edge_features=4,
+                 use_cuda=None):
+        """
+        normalization: for Laplacian None. sym or rw
+        use_cuda: batch the computation on GPU, default: if available
+        """
+        super().__init__(savepath, beta, use_edge_attr, normalization, zero_diag, num_edge_features, use_cuda)
+
+    def compute_pe_from_laplacian(self, L):
+        """exp(-beta * L), L: n x n or batched ... x n x n
+        """
+        return torch.linalg.matrix_exp(-self.beta * L)
 
-    def compute_pe(self, graph):
-        if self.use_edge_attr:
-            # edge_attr_list = F.one_hot(graph.edge_attr - 1, self.num_edge_features).float()
-            edge_attr_list = edge_attr_one_hot(graph.edge_attr, self.num_edge_features)
-            pe_tensors = torch.zeros((self.num_edge_features_true, graph.num_nodes, graph.num_nodes))
-            for i in range(self.num_edge_features_true):
-                pe_i = self.compute_pe_from_edge_weight(
-                    graph.edge_index, edge_attr_list[:, i], graph.num_nodes)
-                pe_tensors[i] = pe_i
-            return pe_tensors
-        return self.compute_pe_from_edge_weight(graph.edge_index, None, graph.num_nodes)
+
+class PStepRWEncoding(LaplacianKernelEncoding):
+    def __init__(self, savepath, p=1, beta=0.5, use_edge_attr=False, normalization=None, zero_diag=False, num_edge_features=4,
+                 use_cuda=None):
+        super().__init__(savepath, beta, use_edge_attr, normalization, zero_diag, num_edge_features, use_cuda)
+        self.p = p
 
     def compute_pe_from_edge_weight(self, edge_index, edge_weight, num_nodes):
-        edge_index, edge_weight = get_laplacian(
-            edge_index, edge_weight, normalization=self.normalization,
-            num_nodes=num_nodes)
-        L = to_scipy_sparse_matrix(edge_index, edge_weight).tocsc()
-        L = sp.identity(L.shape[0], dtype=L.dtype) - self.beta * L
-        tmp = L
-        for _ in range(self.p - 1):
-            tmp = tmp.dot(L)
-        return torch.from_numpy(tmp.toarray())
+        L = dense_laplacian(edge_index, edge_weight, num_nodes, self.normalization)
+        return self.compute_pe_from_laplacian(L)
+
+    def compute_pe_from_laplacian(self, L):
+        """(I - beta * L)^p, L: n x n or batched ... x n x n
+        """
+        M = torch.eye(L.shape[-1], device=L.device) - self.beta * L
+        if self.p == 1:
+            return M
+        return torch.linalg.matrix_power(M, self.p)
 
 
 class AdjEncoding(PositionEncoding):
@@ -138,7 +200,11 @@ class AdjEncoding(PositionEncoding):
         self.normalization = normalization
 
     def compute_pe(self, graph):
-        return to_dense_adj(graph.edge_index)
+        return self.remove_diag(to_dense_adj(graph.edge_index))
+
+    def compute_dataset_pe(self, dataset, n_jobs=None):
+        # too cheap to be worth a process pool
+        return compute_all_pe(self, dataset, n_jobs=1)
 
 class FullEncoding(PositionEncoding):
     def __init__(self, savepath, zero_diag=False):
@@ -148,38 +214,137 @@ class FullEncoding(PositionEncoding):
         super().__init__(savepath, zero_diag)
 
     def compute_pe(self, graph):
-        return torch.ones((graph.num_nodes, graph.num_nodes))
+        return self.remove_diag(torch.ones((graph.num_nodes, graph.num_nodes)))
+
+    def compute_dataset_pe(self, dataset, n_jobs=None):
+        # too cheap to be worth a process pool
+        return compute_all_pe(self, dataset, n_jobs=1)
 
 ## Absolute position encoding
 class LapEncoding(PositionEncoding):
-    def __init__(self, dim, use_edge_attr=False, normalization=None):
+    def __init__(self, dim, use_edge_attr=False, normalization=None, use_cuda=None):
         """
         normalization: for Laplacian None. sym or rw
+        use_cuda: batch the computation on GPU, default: if available
         """
+        self.use_cuda = torch.cuda.is_available() if use_cuda is None else use_cuda
         self.pos_enc_dim = dim
         self.normalization = normalization
         self.use_edge_attr = use_edge_attr
 
-    def compute_pe(self, graph):
+    def eigvec_from_laplacian(self, L):
+        """eigenvectors of a symmetric Laplacian, L: n x n or batched B x n x n
+        eigenvalues are returned in increasing order by eigh
+        """
+        L = 0.5 * (L + L.transpose(-2, -1))
+        EigVal, EigVec = torch.linalg.eigh(L)
+        # copy so that the full n x n eigenvector matrix is not kept alive
+        return EigVec[..., 1:self.pos_enc_dim+1].contiguous()
+
+    def laplacian(self, graph):
         edge_attr = graph.edge_attr if self.use_edge_attr else None
-        edge_index, edge_attr = get_laplacian(
-            graph.edge_index, edge_attr, normalization=self.normalization,
-            num_nodes=graph.num_nodes)
-        L = to_scipy_sparse_matrix(edge_index, edge_attr).tocsc()
-        EigVal, EigVec = np.linalg.eig(L.toarray())
+        return dense_laplacian(
+            graph.edge_index, edge_attr, graph.num_nodes, self.normalization)
+
+    def compute_pe(self, graph):
+        L = self.laplacian(graph)
+        if self.normalization != 'rw':
+            return self.eigvec_from_laplacian(L)
+        # random walk Laplacian is not symmetric
+        EigVal, EigVec = np.linalg.eig(L.numpy())
         idx = EigVal.argsort() # increasing order
         EigVal, EigVec = EigVal[idx], np.real(EigVec[:,idx])
         return torch.from_numpy(EigVec[:, 1:self.pos_enc_dim+1]).float()
 
-    def apply_to(self, dataset):
+    def apply_to(self, dataset, n_jobs=None):
+        """n_jobs: number of CPU processes, unused with use_cuda
+        """
         dataset.lap_pe_list = []
         dataset.lap_pe_dim = self.pos_enc_dim
-        for i, g in enumerate(dataset):
-            pe = self.compute_pe(g)
-            dataset.lap_pe_list.append(pe)
+        if self.use_cuda and self.normalization != 'rw':
+            dataset.lap_pe_list = apply_by_size(
+                self.eigvec_from_laplacian, dataset, self.laplacian)
+        else:
+            dataset.lap_pe_list = compute_all_pe(self, dataset, n_jobs)
 
         return dataset
 
+def _compute_one(pos_encoder, graph):
+    return pos_encoder.compute_pe(graph)
+
+def compute_all_pe(pos_encoder, dataset, n_jobs=None):
+    """compute the PE of every graph in dataset with n_jobs processes
+    n_jobs: None runs serially unless the graphs are large
+    """
+    graphs = graph_structures(dataset)
+    if n_jobs is None:
+        num_nodes = sum(g.num_nodes for g in graphs) / max(len(graphs), 1)
+        n_jobs = -1 if num_nodes >= PARALLEL_MIN_NODES else 1
+    if n_jobs == 1:
+        return [pos_encoder.compute_pe(g) for g in graphs]
+    return Parallel(n_jobs=n_jobs, batch_size=64)(
+        delayed(_compute_one)(pos_encoder, g) for g in graphs)
+
+def graph_structures(dataset):
+    return [GraphStructure(g.edge_index, getattr(g, 'edge_attr', None), g.num_nodes)
+            for g in dataset]
+
+def apply_by_size(func, dataset, build, device='cuda', max_numel=2**24):
+    """apply a batched func on device to the matrices build(g) (... x n x n)
+    of the graphs in dataset. Graphs with the same number of nodes are stacked
+    into calls of about max_numel input elements, built one call at a time
+    """
+    graphs = graph_structures(dataset)
+    buckets = defaultdict(list)
+    for i, g in enumerate(graphs):
+        buckets[g.num_nodes].append(i)
+    outputs = [None] * len(graphs)
+
+    def run(indices, matrices):
+        batch = func(torch.stack(matrices).to(device)).cpu()
+        for i, out in zip(indices, batch):
+            outputs[i] = out
+
+    for bucket in buckets.values():
+        indices, matrices, numel = [], [], 0
+        for i in bucket:
+            mat = build(graphs[i])
+            indices.append(i)
+            matrices.append(mat)
+            numel += mat.numel()
+            if numel >= max_numel:
+                run(indices, matrices)
+                indices, matrices, numel = [], [], 0
+        if indices:
+            run(indices, matrices)
+    return outputs
+
+def dense_laplacian(edge_index, edge_weight, num_nodes, normalization=None):
+    """dense Laplacian (num_nodes x num_nodes float tensor) of a small graph,
+    same as torch_geometric.utils.get_laplacian without the sparse format
+    normalization: None, sym or rw
+    """
+    row, col = edge_index
+    if edge_weight is None:
+        edge_weight = torch.ones(row.shape[0])
+    # self loops are ignored
+    not_loop = row != col
+    A = torch.zeros((num_nodes, num_nodes))
+    A.index_put_((row[not_loop], col[not_loop]), edge_weight[not_loop].float(),
+                 accumulate=True)
+    deg = A.sum(dim=1)
+    if normalization is None:
+        return torch.diag(deg) - A
+    if normalization == 'sym':
+        deg_inv = deg.pow(-0.5)
+        deg_inv[torch.isinf(deg_inv)] = 0
+        A = deg_inv.view(-1, 1) * A * deg_inv.view(1, -1)
+    else:
+        deg_inv = 1. / deg
+        deg_inv[torch.isinf(deg_inv)] = 0
+        A = deg_inv.view(-1, 1) * A
+    return torch.eye(num_nodes) - A
+
 def edge_attr_one_hot(edge_attr, num_edge_features):
     """one hot encoding for edge attributes
     edge_attr: num_edges x edge_types
@@ -187,12 +352,11 @@ def edge_attr_one_hot(edge_attr, num_edge_features):
     """
     if isinstance(num_edge_features, int):
         return F.one_hot(edge_attr - 1, num_edge_features).float()
-    all_one_hot_feat = []
-    for col in range(len(num_edge_features)):
-        one_hot_feat = F.one_hot(edge_attr[:, col], num_edge_features[col])
-        all_one_hot_feat.append(one_hot_feat)
-    all_one_hot_feat = torch.cat(all_one_hot_feat, dim=1)
-    return all_one_hot_feat.float()
+    # shift each column to its block of the output then scatter in one shot
+    offsets = edge_attr.new_tensor([0] + list(accumulate(num_edge_features[:-1])))
+    all_one_hot_feat = torch.zeros((edge_attr.shape[0], sum(num_edge_features)))
+    all_one_hot_feat.scatter_(1, edge_attr + offsets, 1.)
+    return all_one_hot_feat
 
 POSENCODINGS = {
     "diffusion": DiffusionEncoding,
@@ -3,3 +3,44 @@ import torch
 
 def count_parameters(model):
     return sum([p.numel() for p in model.parameters() if p.requires_grad])
+
+
+class CUDAPrefetcher(object):
+    """Wrap a DataLoader so that the host-to-device copy of the next batch
+    runs on a side CUDA stream while the current batch is being processed.
+    Expects a loader with pin_memory=True yielding tuples of tensors or None.
+    """
+    def __init__(self, loader):
+        self.loader = loader
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        self.iterator = iter(self.loader)
+        self.stream = torch.cuda.Stream()
+        self.preload()
+        return self
+
+    def preload(self):
+        try:
+            batch = next(self.iterator)
+        except StopIteration:
+            self.batch = None
+            return
+        with torch.cuda.stream(self.stream):
+            self.batch = tuple(
+                x.to('cuda', non_blocking=True) if x is not None else None
+                for x in batch)
+
+    def __next__(self):
+        if self.batch is None:
+            raise StopIteration
+        current_stream = torch.cuda.current_stream()
+        current_stream.wait_stream(self.stream)
+        batch = self.batch
+        for x in batch:
+            if x is not None:
+                x.record_stream(current_stream)
+        self.preload()
+        return batch